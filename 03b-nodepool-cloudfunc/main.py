@@ -17,10 +17,16 @@ Optional:
   NODE_SHAPE            - Default: VM.Standard.A1.Flex
   NODE_OCPUS            - Default: 2
   NODE_MEMORY_GB        - Default: 12
+  NODE_SHAPE_FALLBACKS  - Smaller configs to try when the default has no capacity,
+                          as comma-separated OCPUSxMEMORY_GB (e.g. "1x6"). Default: none
   NODE_COUNT            - Default: 2
   KUBERNETES_VERSION    - Default: v1.32.1
   NODE_POOL_NAME        - Default: my-nodes
   NOTIFICATION_URL      - Webhook URL to notify on success (optional)
+  WEBHOOK_MAX_ATTEMPTS  - Default: 3 (total delivery attempts for NOTIFICATION_URL, min 1)
+  WEBHOOK_BASE_DELAY_MS - Default: 1000 (first retry delay, doubled per attempt)
+  STATE_COLLECTION      - Firestore collection for state shared across instances
+                          (e.g. "nodepool-creator"). Default: per-instance memory only
 
 Return statuses:
   active         - Node pool is ACTIVE. Stop polling.
@@ -29,13 +35,141 @@ Return statuses:
   stuck_deleted  - Stuck/failed node pool was deleted. Next invocation will retry.
   deleting       - A previous stuck pool is still being deleted. Wait.
   error          - Unexpected error occurred.
+
+Every response also carries "next_poll_seconds", a hint for how long the
+caller should wait before invoking again (0 means stop polling). A
+no_capacity hint points at the end of the CAPACITY_RECHECK_SECONDS window
+that follows a real miss, or later when backing off. After
+CAPACITY_BACKOFF_AFTER_MISSES consecutive no_capacity results the hint grows
+exponentially (5m -> 10m -> ... -> 2h) until capacity is found or a stuck pool
+is deleted.
 """
 
 import os
 import json
-import oci
-from typing import Optional, Tuple
+import random
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from typing import List, Optional, Tuple
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.util.retry import Retry
+
+
+# OCI clients are cached at module scope so warm GCF instances skip PEM
+# parsing and session setup on every invocation. Keyed on the client class
+# and config so a redeploy with new credentials rebuilds them.
+#
+# The oci package itself is imported inside the functions that need it, so the
+# misconfiguration early exit in main never imports it. Any real invocation still
+# imports the oci package (OciRestClient needs its Signer); the Container Engine
+# client and models are only imported on the create/delete path.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+# Shared HTTP session for OciRestClient and the SDK client; keeps connections
+# alive across calls and warm invocations. Idempotent requests are retried on
+# throttling and 5xx; POSTs (capacity reports, create) are not.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+))
+
+# (connect, read) timeout in seconds for OCI REST calls.
+OCI_REQUEST_TIMEOUT = (10, 60)
+
+# Availability domain names never change for a tenancy; cached per compartment.
+_AD_CACHE = {}
+
+# OCID of the node pool found on a previous invocation. Pool OCIDs are stable,
+# so warm instances fetch it directly instead of listing pools by name.
+_LAST_POOL_ID = None
+
+REQUIRED_ENV_VARS = (
+    "OCI_USER_OCID",
+    "OCI_FINGERPRINT",
+    "OCI_TENANCY_OCID",
+    "OCI_REGION",
+    "OCI_CLUSTER_OCID",
+    "OCI_NODE_SUBNET_OCID",
+    "OCI_PRIVATE_KEY",
+)
+
+NON_TERMINAL_STATES = ("ACTIVE", "CREATING", "UPDATING", "NEEDS_ATTENTION", "FAILED", "DELETING")
+
+# Lowercased lifecycleDetails phrase OKE reports on nodes that hit a capacity error.
+CAPACITY_ERROR_DETAIL = "cannot create compute instance"
+
+# Resolved node image IDs keyed on (k8s_version, is_arm) -> (image_id, fetched_at).
+# The node pool options list is large and changes at most daily.
+_IMAGE_CACHE: dict[tuple, tuple[str, float]] = {}
+IMAGE_CACHE_TTL_SECONDS = 3600
+
+# Suggested delay before the next invocation for each returned status.
+# Actionable states poll fast; long OCI-side transitions poll slowly.
+NEXT_POLL_SECONDS = {
+    "active": 0,
+    "creating": 120,
+    "no_capacity": 30,
+    "stuck_deleted": 60,
+    "deleting": 300,
+    "error": 60,
+}
+
+# After a capacity report comes back unavailable, later invocations on this
+# instance answer no_capacity from memory for CAPACITY_RECHECK_SECONDS instead
+# of asking OCI again. Cleared when a pool is created or deleted.
+CAPACITY_RECHECK_SECONDS = 300
+_LAST_CAPACITY_MISS_TS = 0.0
+
+# Consecutive no_capacity results before the poll hint starts backing off,
+# and the longest hint it backs off to.
+CAPACITY_BACKOFF_AFTER_MISSES = 10
+CAPACITY_BACKOFF_BASE_SECONDS = 300
+CAPACITY_BACKOFF_MAX_SECONDS = 7200
+
+# State that must survive cold starts (the consecutive no_capacity count and
+# the work request of a just-started create).
+# Kept in Firestore under STATE_COLLECTION when set; _STATE mirrors it and is
+# the only copy when Firestore is not configured.
+_STATE = {}
+_STATE_LOCK = threading.Lock()
+_FIRESTORE_CLIENT = None
+STATE_DOCUMENT_ID = "state"
+
+# Lease taken before create_node_pool so concurrent invocations (two Scheduler
+# jobs, or several instances) never create duplicate pools. Lives in the
+# "lock" document under STATE_COLLECTION, or in _LEASE for a single instance.
+# After a successful create it is held until it expires, covering the window
+# in which other invocations could still miss the new pool; it is released
+# early only when the create fails.
+CREATE_LEASE_SECONDS = 300
+LOCK_DOCUMENT_ID = "lock"
+_LEASE = {}
+_LEASE_LOCK = threading.Lock()
+
+# How long main waits for a background webhook delivery before returning.
+NOTIFICATION_FLUSH_SECONDS = 0.5
+_NOTIFICATION_THREADS: List[threading.Thread] = []
+
+# Upper bound on a single webhook retry delay, before jitter.
+WEBHOOK_MAX_DELAY_SECONDS = 30
+
+
+def log_structured(message: str, severity: str = "INFO", **fields):
+    """
+    Emit one structured log entry.
+
+    Cloud Functions parses single-line JSON on stdout into jsonPayload, so a
+    whole batch of details lands as one queryable entry instead of many lines.
+    """
+    print(json.dumps({"severity": severity, "message": message, **fields}))
 
 
 def get_config() -> dict:
@@ -51,58 +185,319 @@ def get_config() -> dict:
     }
 
 
-def check_existing_nodepool(ce_client, compartment_id: str, cluster_id: str, name: str) -> Tuple[Optional[str], Optional[str]]:
+class OciRestClient:
+    """
+    Minimal signed REST client for the read endpoints this function polls.
+
+    Only the request signer comes from the OCI SDK; responses are returned as
+    parsed JSON (camelCase dicts) instead of SDK models, which keeps large
+    payloads like node pool options cheap to handle. Node pool create/delete
+    still go through the SDK's ContainerEngineClient.
+    """
+
+    def __init__(self, oci_config: dict):
+        from oci.signer import Signer
+
+        region = oci_config["region"]
+        self.signer = Signer(
+            tenancy=oci_config["tenancy"],
+            user=oci_config["user"],
+            fingerprint=oci_config["fingerprint"],
+            private_key_file_location=None,
+            private_key_content=oci_config["key_content"],
+        )
+        self.container_engine_url = f"https://containerengine.{region}.oci.oraclecloud.com/20180222"
+        self.identity_url = f"https://identity.{region}.oci.oraclecloud.com/20160918"
+        self.compute_url = f"https://iaas.{region}.oraclecloud.com/20160918"
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a signed request, raising requests.HTTPError on 4xx/5xx."""
+        response = _SESSION.request(method, url, auth=self.signer, timeout=OCI_REQUEST_TIMEOUT, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def list_node_pools(self, compartment_id: str, cluster_id: str, name: str, lifecycle_states=None) -> list:
+        """GET /nodePools, optionally filtered by lifecycle state, following opc-next-page pagination."""
+        params = {"compartmentId": compartment_id, "clusterId": cluster_id, "name": name}
+        if lifecycle_states:
+            params["lifecycleState"] = list(lifecycle_states)
+        pools = []
+        while True:
+            response = self._request("GET", f"{self.container_engine_url}/nodePools", params=params)
+            pools.extend(response.json())
+            next_page = response.headers.get("opc-next-page")
+            if not next_page:
+                return pools
+            params["page"] = next_page
+
+    def get_node_pool(self, node_pool_id: str) -> dict:
+        """GET /nodePools/{id}, including its nodes."""
+        return self._request("GET", f"{self.container_engine_url}/nodePools/{node_pool_id}").json()
+
+    def get_node_pool_options(self, compartment_id: str) -> dict:
+        """GET /nodePoolOptions/all."""
+        return self._request("GET", f"{self.container_engine_url}/nodePoolOptions/all",
+                             params={"compartmentId": compartment_id}).json()
+
+    def list_availability_domains(self, compartment_id: str) -> list:
+        """GET /availabilityDomains."""
+        return self._request("GET", f"{self.identity_url}/availabilityDomains",
+                             params={"compartmentId": compartment_id}).json()
+
+    def get_work_request(self, work_request_id: str) -> dict:
+        """GET /workRequests/{id}, including the resources it affects."""
+        return self._request("GET", f"{self.container_engine_url}/workRequests/{work_request_id}").json()
+
+    def create_compute_capacity_report(self, details: dict) -> dict:
+        """POST /computeCapacityReports."""
+        return self._request("POST", f"{self.compute_url}/computeCapacityReports", json=details).json()
+
+
+def _state_document(document_id: str = STATE_DOCUMENT_ID):
+    """Return a Firestore document under STATE_COLLECTION, or None if not configured."""
+    global _FIRESTORE_CLIENT
+    collection = os.environ.get("STATE_COLLECTION")
+    if not collection:
+        return None
+    if _FIRESTORE_CLIENT is None:
+        from google.cloud import firestore
+
+        _FIRESTORE_CLIENT = firestore.Client()
+    return _FIRESTORE_CLIENT.collection(collection).document(document_id)
+
+
+def load_state() -> dict:
+    """Load shared state, falling back to this instance's copy if Firestore fails."""
+    doc = _state_document()
+    if doc is not None:
+        try:
+            data = doc.get().to_dict() or {}
+        except Exception as e:
+            print(f"Error loading state: {e}")
+        else:
+            _STATE.clear()
+            _STATE.update(data)
+    return dict(_STATE)
+
+
+def save_state(**fields):
+    """Merge fields into shared state."""
+    _STATE.update(fields)
+    doc = _state_document()
+    if doc is not None:
+        try:
+            doc.set(fields, merge=True)
+        except Exception as e:
+            print(f"Error saving state: {e}")
+
+
+def acquire_create_lease(owner: str) -> bool:
+    """
+    Atomically claim the right to create the node pool.
+
+    Returns False if another invocation holds an unexpired lease, or if the
+    lease could not be read (failing closed avoids duplicate pools).
+    """
+    now = time.time()
+    doc = _state_document(LOCK_DOCUMENT_ID)
+    if doc is None:
+        with _LEASE_LOCK:
+            if _LEASE.get("locked_until", 0) > now:
+                return False
+            _LEASE.update(locked_until=now + CREATE_LEASE_SECONDS, owner=owner)
+            return True
+
+    from google.cloud import firestore
+
+    @firestore.transactional
+    def claim(transaction) -> bool:
+        lease = doc.get(transaction=transaction).to_dict() or {}
+        if lease.get("locked_until", 0) > now:
+            return False
+        transaction.set(doc, {"locked_until": now + CREATE_LEASE_SECONDS, "owner": owner})
+        return True
+
+    try:
+        return claim(_FIRESTORE_CLIENT.transaction())
+    except Exception as e:
+        print(f"Error acquiring create lease: {e}")
+        return False
+
+
+def release_create_lease(owner: str):
+    """Release the create lease if this invocation still holds it (used when create fails)."""
+    doc = _state_document(LOCK_DOCUMENT_ID)
+    if doc is None:
+        with _LEASE_LOCK:
+            if _LEASE.get("owner") == owner:
+                _LEASE.clear()
+        return
+    try:
+        if (doc.get().to_dict() or {}).get("owner") == owner:
+            doc.delete()
+    except Exception as e:
+        print(f"Error releasing create lease: {e}")
+
+
+def _get_client(client_cls, oci_config: dict):
+    """
+    Return a cached OCI client of the given class, building it on first use.
+
+    Clients survive across warm invocations of the same instance.
+    """
+    key = (client_cls.__name__, hash(tuple(sorted(oci_config.items()))))
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = client_cls(oci_config)
+        return _CLIENTS[key]
+
+
+def _get_container_engine_client(oci_config: dict):
+    """
+    Return the cached SDK ContainerEngineClient, used only for node pool create/delete.
+
+    The client shares _SESSION so its calls reuse the connection to the
+    Container Engine endpoint that the read path already opened.
+    """
+    from oci.container_engine import ContainerEngineClient
+
+    ce_client = _get_client(ContainerEngineClient, oci_config)
+    ce_client.base_client.session = _SESSION
+    return ce_client
+
+
+def get_availability_domains(rest_client: OciRestClient, compartment_id: str) -> list:
+    """List availability domain names, cached for the life of the instance once non-empty."""
+    if compartment_id not in _AD_CACHE:
+        ad_names = [ad["name"] for ad in rest_client.list_availability_domains(compartment_id)]
+        if not ad_names:
+            return ad_names
+        _AD_CACHE[compartment_id] = ad_names
+    return _AD_CACHE[compartment_id]
+
+
+def _forget_work_request(state: dict):
+    """Drop the saved create work request from shared state and this invocation's copy."""
+    state["work_request_id"] = None
+    save_state(work_request_id=None)
+
+
+def get_pool_id_from_work_request(rest_client: OciRestClient, state: dict) -> Optional[str]:
+    """
+    Resolve the node pool OCID from the create work request saved by a previous invocation.
+
+    The work request names the pool directly and, unlike list_node_pools,
+    never lags behind a fresh create. The saved ID is dropped once resolved,
+    or if the work request failed, is gone, or finished without naming a
+    pool. While it stays saved the create is still pending, and callers must
+    not fall back to listing by name. `state` is this invocation's copy from
+    load_state and is updated in place.
+    """
+    work_request_id = state.get("work_request_id")
+    if not work_request_id:
+        return None
+    try:
+        work_request = rest_client.get_work_request(work_request_id)
+        if work_request.get("status") in ("FAILED", "CANCELED"):
+            print(f"Create work request {work_request_id} is {work_request['status']}")
+            _forget_work_request(state)
+            return None
+        for resource in work_request.get("resources") or []:
+            if (resource.get("entityType") or "").lower() == "nodepool" and resource.get("identifier"):
+                _forget_work_request(state)
+                return resource["identifier"]
+        if work_request.get("status") == "SUCCEEDED":
+            print(f"Create work request {work_request_id} succeeded without a node pool resource")
+            _forget_work_request(state)
+    except requests.HTTPError as e:
+        if e.response.status_code == 404:
+            _forget_work_request(state)
+        print(f"Error fetching work request: {e}")
+    except Exception as e:
+        print(f"Error fetching work request: {e}")
+    return None
+
+
+def get_known_nodepool(rest_client: OciRestClient, state: dict) -> Optional[dict]:
+    """
+    Fetch the node pool remembered from a previous invocation, if any.
+
+    The pool comes from this instance's memory or from a pending create work
+    request. Returns the full node pool (including nodes) when it is still in
+    a non-terminal state, otherwise forgets it and returns None so the caller
+    falls back to listing pools by name.
+    """
+    global _LAST_POOL_ID
+    if not _LAST_POOL_ID:
+        _LAST_POOL_ID = get_pool_id_from_work_request(rest_client, state)
+    if not _LAST_POOL_ID:
+        return None
+    try:
+        pool = rest_client.get_node_pool(_LAST_POOL_ID)
+        if pool["lifecycleState"] in NON_TERMINAL_STATES:
+            return pool
+        _LAST_POOL_ID = None
+    except requests.HTTPError as e:
+        if e.response.status_code == 404:
+            _LAST_POOL_ID = None
+        print(f"Error fetching known node pool: {e}")
+    except Exception as e:
+        print(f"Error fetching known node pool: {e}")
+    return None
+
+
+def check_existing_nodepool(rest_client: OciRestClient, compartment_id: str, cluster_id: str, name: str) -> Tuple[Optional[str], Optional[str]]:
     """
     Check for any existing node pool matching the name.
 
     Returns (nodepool_id, lifecycle_state) or (None, None) if no pool found.
-    Searches across all non-terminal states.
+    OCI filters to non-terminal states server-side, so deleted pools with the
+    same name are never returned. Remembers the pool for the next invocation.
     """
-    NON_TERMINAL_STATES = {"ACTIVE", "CREATING", "UPDATING", "NEEDS_ATTENTION", "FAILED", "DELETING"}
+    global _LAST_POOL_ID
     try:
-        response = ce_client.list_node_pools(
-            compartment_id=compartment_id,
-            cluster_id=cluster_id,
-            name=name,
-        )
-        for pool in (response.data or []):
-            if pool.lifecycle_state in NON_TERMINAL_STATES:
-                return pool.id, pool.lifecycle_state
+        pools = rest_client.list_node_pools(compartment_id, cluster_id, name, lifecycle_states=NON_TERMINAL_STATES)
+        if pools:
+            _LAST_POOL_ID = pools[0]["id"]
+            return pools[0]["id"], pools[0]["lifecycleState"]
     except Exception as e:
         print(f"Error checking existing node pool: {e}")
     return None, None
 
 
-def is_nodepool_stuck(ce_client, nodepool_id: str) -> bool:
+def is_nodepool_stuck(rest_client: OciRestClient, nodepool_id: str, pool: Optional[dict] = None) -> bool:
     """
     Check if a CREATING/UPDATING node pool is stuck due to capacity.
 
-    A pool is stuck when all nodes have lifecycle_details containing
-    'cannot create compute instance'.
+    A pool is stuck when all nodes have lifecycleDetails containing
+    CAPACITY_ERROR_DETAIL. Pass an already-fetched node pool as
+    `pool` to skip the GET.
     """
     try:
-        response = ce_client.get_node_pool(node_pool_id=nodepool_id)
-        nodes = response.data.nodes or []
+        if pool is None:
+            pool = rest_client.get_node_pool(nodepool_id)
+        nodes = pool.get("nodes") or []
 
         if not nodes:
             # No nodes yet — pool just started creating, not stuck
             print("  No nodes in pool yet, still initializing")
             return False
 
-        stuck_count = 0
-        for node in nodes:
-            details = (node.lifecycle_details or "").lower()
-            state = node.lifecycle_state or ""
-            print(f"  Node {node.name}: state={state}, details={details}")
-            if "cannot create compute instance" in details:
-                stuck_count += 1
-
-        if stuck_count == len(nodes):
-            print(f"  All {len(nodes)} nodes stuck with capacity errors")
-            return True
-
-        print(f"  {stuck_count}/{len(nodes)} nodes stuck, not all — still progressing")
-        return False
+        stuck = all(CAPACITY_ERROR_DETAIL in (node.get("lifecycleDetails") or "").lower() for node in nodes)
+        log_structured(
+            "pool-check",
+            nodepool_id=nodepool_id,
+            stuck=stuck,
+            nodes=[
+                {
+                    "name": node.get("name"),
+                    "state": node.get("lifecycleState"),
+                    "details": node.get("lifecycleDetails"),
+                }
+                for node in nodes
+            ],
+        )
+        return stuck
 
     except Exception as e:
         print(f"Error inspecting node pool nodes: {e}")
@@ -111,65 +506,139 @@ def is_nodepool_stuck(ce_client, nodepool_id: str) -> bool:
 
 def delete_nodepool(ce_client, nodepool_id: str) -> bool:
     """Delete a stuck/failed node pool. Returns True if delete was initiated."""
+    global _LAST_POOL_ID
     try:
         print(f"Deleting stuck node pool: {nodepool_id}")
         ce_client.delete_node_pool(node_pool_id=nodepool_id)
+        _LAST_POOL_ID = None
         return True
     except Exception as e:
         print(f"Error deleting node pool: {e}")
         return False
 
 
-def check_capacity(compute_client, compartment_id: str, ad_name: str, shape: str, ocpus: int, memory_gb: int) -> bool:
-    """Check if capacity is available for the requested shape."""
+def parse_shape_configs(value: str) -> List[Tuple[int, int]]:
+    """
+    Parse "OCPUSxMEMORY_GB,..." (e.g. "2x12,1x6") into [(ocpus, memory_gb), ...].
+
+    Raises ValueError naming the offending entry if it is not in that format.
+    """
+    configs = []
+    for item in value.split(","):
+        if item.strip():
+            try:
+                ocpus, memory_gb = item.strip().lower().split("x")
+                configs.append((int(ocpus), int(memory_gb)))
+            except ValueError:
+                raise ValueError(f"invalid shape config {item.strip()!r}, expected OCPUSxGB (e.g. 1x6)")
+    return configs
+
+
+def check_capacity(rest_client: OciRestClient, compartment_id: str, ad_name: str, shape: str,
+                   configs: List[Tuple[int, int]]) -> Optional[List[Tuple[int, int, str]]]:
+    """
+    Check capacity for several shape configs in one capacity report.
+
+    Returns [(ocpus, memory_gb, availability_status), ...] in the order of
+    `configs` (status "UNKNOWN" if OCI did not report that config), or None if the report failed (so callers can tell an OCI
+    error apart from a real "no capacity" answer).
+    """
     try:
-        response = compute_client.create_compute_capacity_report(
-            create_compute_capacity_report_details=oci.core.models.CreateComputeCapacityReportDetails(
-                compartment_id=compartment_id,
-                availability_domain=ad_name,
-                shape_availabilities=[
-                    oci.core.models.CreateCapacityReportShapeAvailabilityDetails(
-                        instance_shape=shape,
-                        instance_shape_config=oci.core.models.CapacityReportInstanceShapeConfig(
-                            ocpus=float(ocpus),
-                            memory_in_gbs=float(memory_gb)
-                        )
-                    )
-                ]
-            )
-        )
+        report = rest_client.create_compute_capacity_report({
+            "compartmentId": compartment_id,
+            "availabilityDomain": ad_name,
+            "shapeAvailabilities": [
+                {
+                    "instanceShape": shape,
+                    "instanceShapeConfig": {
+                        "ocpus": float(ocpus),
+                        "memoryInGBs": float(memory_gb),
+                    },
+                }
+                for ocpus, memory_gb in configs
+            ],
+        })
 
-        status = response.data.shape_availabilities[0].availability_status
-        print(f"Capacity status for {shape}: {status}")
-        return status == "AVAILABLE"
+        # Match results on the config OCI echoes back, not on position
+        statuses = {}
+        for availability in report["shapeAvailabilities"]:
+            shape_config = availability.get("instanceShapeConfig") or {}
+            key = (float(shape_config.get("ocpus") or 0), float(shape_config.get("memoryInGBs") or 0))
+            statuses[key] = availability["availabilityStatus"]
+        results = [
+            (ocpus, memory_gb, statuses.get((float(ocpus), float(memory_gb)), "UNKNOWN"))
+            for ocpus, memory_gb in configs
+        ]
+        summary = ", ".join(f"{ocpus}x{memory_gb}GB={status}" for ocpus, memory_gb, status in results)
+        print(f"Capacity status for {shape} in {ad_name}: {summary}")
+        return results
 
     except Exception as e:
         print(f"Error checking capacity: {e}")
-        return False
+        return None
+
+
+def find_available_capacity(rest_client: OciRestClient, compartment_id: str, ad_names: List[str], shape: str,
+                            configs: List[Tuple[int, int]]) -> Optional[Tuple[str, int, int]]:
+    """
+    Run the capacity report for every availability domain concurrently.
+
+    Returns (ad_name, ocpus, memory_gb) for the first AVAILABLE config,
+    preferring earlier ADs and then earlier configs, or None if every report
+    came back without capacity. Raises RuntimeError if there are no ADs to
+    check, or if nothing was available and at least one report failed, since
+    neither is a real capacity miss.
+    """
+    if not ad_names:
+        raise RuntimeError(f"No availability domains found for compartment {compartment_id}")
 
+    with ThreadPoolExecutor(max_workers=len(ad_names)) as executor:
+        reports = list(executor.map(
+            lambda ad_name: check_capacity(rest_client, compartment_id, ad_name, shape, configs), ad_names))
 
-def get_node_image_id(ce_client, compartment_id: str, k8s_version: str, is_arm: bool) -> Optional[str]:
-    """Get the appropriate OKE node image ID."""
+    for ad_name, results in zip(ad_names, reports):
+        for ocpus, memory_gb, status in results or []:
+            if status == "AVAILABLE":
+                return ad_name, ocpus, memory_gb
+
+    failed = [ad_name for ad_name, results in zip(ad_names, reports) if results is None]
+    if failed:
+        raise RuntimeError(f"Capacity report failed for {', '.join(failed)}")
+    return None
+
+
+def get_node_image_id(rest_client: OciRestClient, compartment_id: str, k8s_version: str, is_arm: bool) -> Optional[str]:
+    """Get the appropriate OKE node image ID, cached for IMAGE_CACHE_TTL_SECONDS."""
+    cache_key = (k8s_version, is_arm)
+    cached = _IMAGE_CACHE.get(cache_key)
+    if cached and time.time() - cached[1] < IMAGE_CACHE_TTL_SECONDS:
+        return cached[0]
+
+    image_id = _lookup_node_image_id(rest_client, compartment_id, k8s_version, is_arm)
+    if image_id:
+        _IMAGE_CACHE[cache_key] = (image_id, time.time())
+    return image_id
+
+
+def _lookup_node_image_id(rest_client: OciRestClient, compartment_id: str, k8s_version: str, is_arm: bool) -> Optional[str]:
+    """Scan the node pool options for an image matching the version and architecture."""
     try:
-        response = ce_client.get_node_pool_options(
-            node_pool_option_id="all",
-            compartment_id=compartment_id
-        )
+        sources = rest_client.get_node_pool_options(compartment_id).get("sources") or []
 
         version_prefix = k8s_version.lstrip("v")
 
-        for source in response.data.sources:
-            source_name = source.source_name or ""
+        for source in sources:
+            source_name = source.get("sourceName") or ""
             if version_prefix in source_name:
                 if is_arm and "aarch64" in source_name:
-                    return source.image_id
+                    return source["imageId"]
                 elif not is_arm and "aarch64" not in source_name and "GPU" not in source_name:
-                    return source.image_id
+                    return source["imageId"]
 
         # Fallback: any image with matching version
-        for source in response.data.sources:
-            if version_prefix in (source.source_name or ""):
-                return source.image_id
+        for source in sources:
+            if version_prefix in (source.get("sourceName") or ""):
+                return source["imageId"]
 
     except Exception as e:
         print(f"Error getting node image: {e}")
@@ -178,23 +647,25 @@ def get_node_image_id(ce_client, compartment_id: str, k8s_version: str, is_arm:
 
 def create_nodepool(ce_client, config: dict) -> dict:
     """Create the node pool."""
-    create_details = oci.container_engine.models.CreateNodePoolDetails(
+    from oci.container_engine import models
+
+    create_details = models.CreateNodePoolDetails(
         compartment_id=config["compartment_id"],
         cluster_id=config["cluster_id"],
         name=config["node_pool_name"],
         kubernetes_version=config["k8s_version"],
         node_shape=config["node_shape"],
-        node_shape_config=oci.container_engine.models.CreateNodeShapeConfigDetails(
+        node_shape_config=models.CreateNodeShapeConfigDetails(
             ocpus=float(config["ocpus"]),
             memory_in_gbs=float(config["memory_gb"])
         ),
-        node_source_details=oci.container_engine.models.NodeSourceViaImageDetails(
+        node_source_details=models.NodeSourceViaImageDetails(
             image_id=config["image_id"]
         ),
-        node_config_details=oci.container_engine.models.CreateNodePoolNodeConfigDetails(
+        node_config_details=models.CreateNodePoolNodeConfigDetails(
             size=config["node_count"],
             placement_configs=[
-                oci.container_engine.models.NodePoolPlacementConfigDetails(
+                models.NodePoolPlacementConfigDetails(
                     availability_domain=config["ad_name"],
                     subnet_id=config["subnet_id"]
                 )
@@ -209,17 +680,119 @@ def create_nodepool(ce_client, config: dict) -> dict:
     }
 
 
+def record_capacity_miss() -> int:
+    """
+    Count another consecutive no_capacity result and return the new total.
+
+    The increment runs in a Firestore transaction so concurrent instances
+    never lose a miss; if Firestore fails it falls back to this instance's copy.
+    """
+    doc = _state_document()
+    if doc is None:
+        with _STATE_LOCK:
+            _STATE["capacity_misses"] = _STATE.get("capacity_misses", 0) + 1
+            return _STATE["capacity_misses"]
+
+    from google.cloud import firestore
+
+    @firestore.transactional
+    def increment(transaction) -> int:
+        state = doc.get(transaction=transaction).to_dict() or {}
+        misses = (state.get("capacity_misses") or 0) + 1
+        transaction.set(doc, {"capacity_misses": misses}, merge=True)
+        return misses
+
+    try:
+        misses = increment(_FIRESTORE_CLIENT.transaction())
+    except Exception as e:
+        print(f"Error recording capacity miss: {e}")
+        misses = _STATE.get("capacity_misses", 0) + 1
+    _STATE["capacity_misses"] = misses
+    return misses
+
+
+def reset_capacity_misses(state: dict):
+    """Clear the no_capacity count and recheck window after capacity appears or a pool is deleted."""
+    global _LAST_CAPACITY_MISS_TS
+    _LAST_CAPACITY_MISS_TS = 0.0
+    if state.get("capacity_misses"):
+        save_state(capacity_misses=0)
+
+
+def capacity_backoff_seconds(misses: int) -> int:
+    """Poll hint after `misses` consecutive no_capacity results."""
+    if misses < CAPACITY_BACKOFF_AFTER_MISSES:
+        return NEXT_POLL_SECONDS["no_capacity"]
+    backoff = CAPACITY_BACKOFF_BASE_SECONDS * 2 ** (misses - CAPACITY_BACKOFF_AFTER_MISSES)
+    return min(CAPACITY_BACKOFF_MAX_SECONDS, backoff)
+
+
+def make_response(status: str, next_poll_seconds: Optional[int] = None, **fields) -> dict:
+    """
+    Build the response, including the next_poll_seconds hint (defaults per status).
+
+    Returned as a dict; the Functions Framework serializes it to JSON once.
+    """
+    if next_poll_seconds is None:
+        next_poll_seconds = NEXT_POLL_SECONDS[status]
+    return {"status": status, **fields, "next_poll_seconds": next_poll_seconds}
+
+
+def _deliver_notification(url: str, message: str):
+    """
+    POST the webhook payload, retrying transient failures. Runs on a background thread.
+
+    5xx, 429 and network errors are retried with exponential backoff plus up to
+    25% jitter; other 4xx responses are treated as permanent.
+    """
+    max_attempts = max(1, int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "3")))
+    base_delay = int(os.environ.get("WEBHOOK_BASE_DELAY_MS", "1000")) / 1000
+    data = json.dumps({"text": message}).encode("utf-8")
+
+    for attempt in range(max_attempts):
+        try:
+            req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(req, timeout=5)
+            print(f"Notification sent: {message}")
+            return
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code != 429:
+                print(f"Failed to send notification (not retrying): {e}")
+                return
+            error = e
+        except Exception as e:
+            error = e
+
+        if attempt < max_attempts - 1:
+            delay = min(WEBHOOK_MAX_DELAY_SECONDS, base_delay * 2 ** attempt) * (1 + random.random() * 0.25)
+            print(f"Notification attempt {attempt + 1} failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+        else:
+            print(f"Failed to send notification after {max_attempts} attempts: {error}")
+
+
 def send_notification(url: str, message: str):
-    """Send a webhook notification."""
+    """
+    Send a webhook notification without holding up the response.
+
+    Delivery runs on a daemon thread; we wait at most NOTIFICATION_FLUSH_SECONDS
+    for it. GCF may throttle the instance once main returns, so delivery of a
+    slow webhook is best-effort.
+    """
     if not url:
         return
-    try:
-        data = json.dumps({"text": message}).encode("utf-8")
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-        urllib.request.urlopen(req, timeout=10)
-        print(f"Notification sent: {message}")
-    except Exception as e:
-        print(f"Failed to send notification: {e}")
+    thread = threading.Thread(target=_deliver_notification, args=(url, message), daemon=True)
+    thread.start()
+    _NOTIFICATION_THREADS[:] = [t for t in _NOTIFICATION_THREADS if t.is_alive()]
+    _NOTIFICATION_THREADS.append(thread)
+    thread.join(timeout=NOTIFICATION_FLUSH_SECONDS)
+
+
+def wait_for_notifications():
+    """Block until every outstanding notification has been delivered or given up on."""
+    for thread in _NOTIFICATION_THREADS:
+        thread.join()
+    _NOTIFICATION_THREADS.clear()
 
 
 def main(request=None):
@@ -228,14 +801,30 @@ def main(request=None):
 
     State machine:
       1. Check for existing node pool in any non-terminal state
+         (a pending create work request that names no pool yet -> return "creating")
       2. If ACTIVE         -> return "active" (stop polling)
       3. If CREATING       -> check if stuck (all nodes have capacity errors)
                               If stuck -> delete pool, return "stuck_deleted"
                               If progressing -> return "creating" (wait)
       4. If NEEDS_ATTENTION/FAILED -> delete pool, return "stuck_deleted"
       5. If DELETING       -> return "deleting" (wait for cleanup)
-      6. If no pool exists -> check capacity -> create if available
+      6. If no pool exists -> check capacity (unless it was unavailable within
+                              CAPACITY_RECHECK_SECONDS) -> take create lease -> create if available
     """
+    global _LAST_CAPACITY_MISS_TS
+
+    # Fail fast on misconfiguration, before any OCI import or signer setup
+    missing = [name for name in REQUIRED_ENV_VARS if not os.environ.get(name)]
+    if missing:
+        print(f"Missing required environment variables: {', '.join(missing)}")
+        return make_response("error", message=f"Missing required environment variables: {', '.join(missing)}")
+
+    try:
+        fallback_configs = parse_shape_configs(os.environ.get("NODE_SHAPE_FALLBACKS", ""))
+    except ValueError as e:
+        print(f"Invalid NODE_SHAPE_FALLBACKS: {e}")
+        return make_response("error", message=f"Invalid NODE_SHAPE_FALLBACKS: {e}")
+
     try:
         # Load configuration
         oci_config = get_config()
@@ -247,6 +836,7 @@ def main(request=None):
         node_shape = os.environ.get("NODE_SHAPE", "VM.Standard.A1.Flex")
         node_ocpus = int(os.environ.get("NODE_OCPUS", "2"))
         node_memory_gb = int(os.environ.get("NODE_MEMORY_GB", "12"))
+        shape_configs = [(node_ocpus, node_memory_gb)] + fallback_configs
         node_count = int(os.environ.get("NODE_COUNT", "2"))
         k8s_version = os.environ.get("KUBERNETES_VERSION", "v1.32.1")
         node_pool_name = os.environ.get("NODE_POOL_NAME", "my-nodes")
@@ -254,13 +844,26 @@ def main(request=None):
 
         is_arm = "A1" in node_shape
 
-        # Initialize clients
-        ce_client = oci.container_engine.ContainerEngineClient(oci_config)
-        compute_client = oci.core.ComputeClient(oci_config)
-        identity_client = oci.identity.IdentityClient(oci_config)
+        # Reads go through the lightweight REST client; the SDK client is only
+        # built for create/delete (both reused across warm invocations)
+        rest_client = _get_client(OciRestClient, oci_config)
+
+        # Shared state is read once per invocation; only the miss increment and
+        # the create lease go back to Firestore
+        state = load_state()
 
         # --- State machine: check existing node pool ---
-        pool_id, pool_state = check_existing_nodepool(ce_client, compartment_id, cluster_id, node_pool_name)
+        known_pool = get_known_nodepool(rest_client, state)
+        if known_pool:
+            pool_id, pool_state = known_pool["id"], known_pool["lifecycleState"]
+        else:
+            # A create whose work request does not name the pool yet; listing by
+            # name can lag a fresh create, so wait rather than risk a duplicate
+            pending_work_request_id = state.get("work_request_id")
+            if pending_work_request_id:
+                print(f"Create work request {pending_work_request_id} still pending — waiting")
+                return make_response("creating", work_request_id=pending_work_request_id)
+            pool_id, pool_state = check_existing_nodepool(rest_client, compartment_id, cluster_id, node_pool_name)
 
         if pool_id:
             print(f"Found node pool {pool_id} in state: {pool_state}")
@@ -269,71 +872,112 @@ def main(request=None):
                 print("Node pool is ACTIVE — done!")
                 send_notification(notification_url,
                     f"✅ OCI Node Pool is ACTIVE: {pool_id}")
-                return json.dumps({"status": "active", "nodepool_id": pool_id})
+                return make_response("active", nodepool_id=pool_id)
 
             elif pool_state in ("CREATING", "UPDATING"):
                 print("Node pool is CREATING/UPDATING — checking if stuck...")
-                if is_nodepool_stuck(ce_client, pool_id):
-                    delete_nodepool(ce_client, pool_id)
-                    return json.dumps({"status": "stuck_deleted", "deleted_id": pool_id,
-                                       "message": "Stuck node pool deleted, will retry on next invocation"})
+                if is_nodepool_stuck(rest_client, pool_id, pool=known_pool):
+                    delete_nodepool(_get_container_engine_client(oci_config), pool_id)
+                    reset_capacity_misses(state)
+                    return make_response("stuck_deleted", deleted_id=pool_id,
+                                         message="Stuck node pool deleted, will retry on next invocation")
                 else:
                     print("Node pool creation is progressing normally")
-                    return json.dumps({"status": "creating", "nodepool_id": pool_id})
+                    return make_response("creating", nodepool_id=pool_id)
 
             elif pool_state in ("NEEDS_ATTENTION", "FAILED"):
                 print(f"Node pool is {pool_state} — deleting to retry")
-                delete_nodepool(ce_client, pool_id)
-                return json.dumps({"status": "stuck_deleted", "deleted_id": pool_id,
-                                   "message": f"Pool in {pool_state} state deleted, will retry on next invocation"})
+                delete_nodepool(_get_container_engine_client(oci_config), pool_id)
+                reset_capacity_misses(state)
+                return make_response("stuck_deleted", deleted_id=pool_id,
+                                     message=f"Pool in {pool_state} state deleted, will retry on next invocation")
 
             elif pool_state == "DELETING":
                 print("Node pool is being deleted from a previous cleanup — waiting")
-                return json.dumps({"status": "deleting", "nodepool_id": pool_id})
+                return make_response("deleting", nodepool_id=pool_id)
 
         # --- No existing pool: check capacity and create ---
-        # Get availability domain
-        ads = identity_client.list_availability_domains(compartment_id=compartment_id).data
-        ad_name = ads[0].name
-        print(f"Using availability domain: {ad_name}")
-
-        # Check capacity
-        if not check_capacity(compute_client, compartment_id, ad_name, node_shape, node_ocpus, node_memory_gb):
-            print("Capacity not available, will retry on next invocation")
-            return json.dumps({"status": "no_capacity"})
+        # Capacity was unavailable moments ago — skip the report until the window passes
+        since_miss = time.time() - _LAST_CAPACITY_MISS_TS
+        if since_miss < CAPACITY_RECHECK_SECONDS:
+            misses = state.get("capacity_misses", 0)
+            remaining = int(CAPACITY_RECHECK_SECONDS - since_miss) + 1
+            print(f"Capacity was unavailable {since_miss:.0f}s ago, skipping capacity report")
+            return make_response("no_capacity", next_poll_seconds=max(remaining, capacity_backoff_seconds(misses)),
+                                 consecutive_misses=misses, cached=True)
+
+        # Check capacity in every availability domain at once; first AVAILABLE config wins
+        ad_names = get_availability_domains(rest_client, compartment_id)
+        available = find_available_capacity(rest_client, compartment_id, ad_names, node_shape, shape_configs)
+
+        if not available:
+            _LAST_CAPACITY_MISS_TS = time.time()
+            misses = record_capacity_miss()
+            print(f"Capacity not available ({misses} consecutive), will retry on next invocation")
+            # Never hint sooner than the recheck window, or the next call is a cached answer
+            return make_response("no_capacity",
+                                 next_poll_seconds=max(CAPACITY_RECHECK_SECONDS, capacity_backoff_seconds(misses)),
+                                 consecutive_misses=misses)
+
+        reset_capacity_misses(state)
+
+        ad_name, node_ocpus, node_memory_gb = available
+        print(f"Using availability domain {ad_name} with {node_ocpus} OCPUs / {node_memory_gb} GB")
 
         # Capacity available! Get node image and create pool
         print("Capacity AVAILABLE! Creating node pool...")
 
-        image_id = get_node_image_id(ce_client, compartment_id, k8s_version, is_arm)
+        image_id = get_node_image_id(rest_client, compartment_id, k8s_version, is_arm)
         if not image_id:
-            return json.dumps({"status": "error", "message": "Could not find node image"})
-
-        result = create_nodepool(ce_client, {
-            "compartment_id": compartment_id,
-            "cluster_id": cluster_id,
-            "node_pool_name": node_pool_name,
-            "k8s_version": k8s_version,
-            "node_shape": node_shape,
-            "ocpus": node_ocpus,
-            "memory_gb": node_memory_gb,
-            "node_count": node_count,
-            "image_id": image_id,
-            "ad_name": ad_name,
-            "subnet_id": subnet_id,
-        })
+            return make_response("error", message="Could not find node image")
+
+        # Only one concurrent invocation may create the pool
+        lease_owner = uuid.uuid4().hex
+        if not acquire_create_lease(lease_owner):
+            print("Another invocation is creating the node pool — skipping create")
+            return make_response("creating", message="Node pool creation already in progress elsewhere")
+
+        # A create may have started since this invocation looked for a pool
+        pending_work_request_id = state.get("work_request_id")
+        if pending_work_request_id:
+            print(f"Create already started (work request {pending_work_request_id}) — skipping create")
+            return make_response("creating", work_request_id=pending_work_request_id)
+
+        try:
+            ce_client = _get_container_engine_client(oci_config)
+            result = create_nodepool(ce_client, {
+                "compartment_id": compartment_id,
+                "cluster_id": cluster_id,
+                "node_pool_name": node_pool_name,
+                "k8s_version": k8s_version,
+                "node_shape": node_shape,
+                "ocpus": node_ocpus,
+                "memory_gb": node_memory_gb,
+                "node_count": node_count,
+                "image_id": image_id,
+                "ad_name": ad_name,
+                "subnet_id": subnet_id,
+            })
+        except Exception:
+            release_create_lease(lease_owner)
+            raise
+
+        # Lets the next invocation find the pool via the work request
+        save_state(work_request_id=result["work_request_id"])
 
         send_notification(notification_url,
             f"🎉 OCI Node Pool creation started! Work request: {result['work_request_id']}")
 
-        return json.dumps({"status": "creating", **result})
+        return make_response(**result)
 
     except Exception as e:
         error_msg = str(e)
         print(f"Error: {error_msg}")
-        return json.dumps({"status": "error", "message": error_msg})
+        return make_response("error", message=error_msg)
 
 
 # For local testing
 if __name__ == "__main__":
-    print(main())
+    print(json.dumps(main()))
+    # Daemon threads die with the interpreter; let pending retries finish
+    wait_for_notifications()
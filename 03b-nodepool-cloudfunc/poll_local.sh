@@ -1,5 +1,9 @@
 #!/bin/bash
-# Poll the cloud function locally every 60 seconds until capacity is found
+# Poll the cloud function locally until capacity is found
+# Waits the function's next_poll_seconds hint between attempts,
+# falling back to POLL_INTERVAL (default 60s) when none is returned.
+# For no_capacity the wait is capped at POLL_INTERVAL: each attempt is a
+# fresh process, so the function's in-memory recheck window never applies.
 # Usage: bash poll_local.sh
 # Stop with Ctrl+C
 
@@ -8,7 +12,7 @@ set -uo pipefail
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 POLL_INTERVAL="${POLL_INTERVAL:-60}"
 
-echo "=== Starting capacity polling (every ${POLL_INTERVAL}s) ==="
+echo "=== Starting capacity polling (default every ${POLL_INTERVAL}s) ==="
 echo "    Press Ctrl+C to stop"
 echo ""
 echo "💡 TIP: If you're on the 30-day free trial and A1 capacity is scarce,"
@@ -24,6 +28,8 @@ while true; do
   
   RESULT=$(bash "${SCRIPT_DIR}/test_local.sh" 2>&1)
   STATUS=$(echo "$RESULT" | tail -1 | python3 -c "import sys,json; print(json.loads(sys.stdin.read()).get('status','unknown'))" 2>/dev/null || echo "unknown")
+  NEXT_POLL=$(echo "$RESULT" | tail -1 | python3 -c "import sys,json; print(json.loads(sys.stdin.read()).get('next_poll_seconds',''))" 2>/dev/null || echo "")
+  NEXT_POLL="${NEXT_POLL:-$POLL_INTERVAL}"
   
   echo "[$(date '+%Y-%m-%d %H:%M:%S')] Status: ${STATUS}"
   
@@ -36,7 +42,10 @@ while true; do
       echo "[$(date '+%Y-%m-%d %H:%M:%S')] Node pool is being created, will check again..."
       ;;
     no_capacity)
-      echo "[$(date '+%Y-%m-%d %H:%M:%S')] No capacity yet, retrying in ${POLL_INTERVAL}s..."
+      if [ "$NEXT_POLL" -gt "$POLL_INTERVAL" ]; then
+        NEXT_POLL="$POLL_INTERVAL"
+      fi
+      echo "[$(date '+%Y-%m-%d %H:%M:%S')] No capacity yet, retrying in ${NEXT_POLL}s..."
       ;;
     stuck_deleted)
       echo "[$(date '+%Y-%m-%d %H:%M:%S')] Stuck pool deleted, will retry..."
@@ -51,5 +60,5 @@ while true; do
   esac
   
   echo ""
-  sleep $POLL_INTERVAL
+  sleep "$NEXT_POLL"
 done
@@ -2,7 +2,7 @@
 # Test the Cloud Function locally
 #
 # Prerequisites:
-#   - pip install oci
+#   - pip install -r requirements.txt
 #   - Run scripts 01, 02, 03a first
 #   - Have ~/.oci/config set up
 